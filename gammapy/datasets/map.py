@@ -1466,12 +1466,11 @@ class MapDataset(Dataset):
 
         return ax_spatial, ax_spectral
 
-    def stat_sum(self):
-        """Total statistic function value given the current model parameters and priors."""
-        prior_stat_sum = 0.0
-        if self.models is not None:
-            prior_stat_sum = self.models.parameters.prior_stat_sum()
+    def _stat_sum_likelihood(self):
+        """Total statistic function value given the current model parameters without the priors.
 
+        Uses the compiled Cash statistic kernels instead of summing `stat_array`.
+        """
         counts, npred = self.counts.data.astype(float), self.npred().data
 
         if self.mask is not None:
@@ -1490,7 +1489,7 @@ class MapDataset(Dataset):
                 )
         else:
             cash_sum = cash_sum_cython(counts.ravel(), npred.ravel())
-        return cash_sum + prior_stat_sum
+        return cash_sum
 
     def _to_asimov_dataset(self):
         """Create Asimov dataset from the current models."""
@@ -2864,6 +2863,10 @@ class MapDatasetOnOff(MapDataset):
         else:
             return Dataset.stat_sum(self)
 
+    def _stat_sum_likelihood(self):
+        """Total statistic function value given the current model parameters without the priors."""
+        return Dataset._stat_sum_likelihood(self)
+
     def fake(self, npred_background, random_state="random-seed"):
         """Simulate fake counts (on and off) for the current model and reduced IRFs.
 
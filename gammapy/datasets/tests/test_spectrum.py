@@ -1138,6 +1138,8 @@ class TestFit:
 
         stat_val = dataset.stat_sum()
         assert_allclose(stat_val, -107346.5291, rtol=1e-5)
+        assert_allclose(dataset._stat_sum_likelihood(), stat_val)
+        assert_allclose(stat_val, np.sum(dataset.stat_array()), rtol=1e-5)
 
         self.source_model.parameters["index"].value = 1.12
 
@@ -1,6 +1,10 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 """Sampler parameter classes."""
 
+import numpy as np
+from scipy.special import ndtri
+from gammapy.modeling.models import GaussianPrior, LogUniformPrior, UniformPrior
+from .covariance import Covariance
 from .utils import _parse_datasets
 
 __all__ = ["Sampler", "SamplerLikelihood", "SamplerResult"]
@@ -42,16 +46,59 @@ class Sampler:
         nsteps : int
                 Number of steps to take in each direction in the step sampler. Increase this number to get more accurate results at the cost of more computation time.
                 Default is 10.
+        population : bool
+                Use the vectorized `PopulationSliceSampler` as step sampler, which evaluates many walkers at once.
+                This implies step_sampler. Default is False.
+        popsize : int
+                Number of walkers of the population step sampler.
+                Default is live_points.
+        verbose : bool
+                Print the summary of the results after the run. The sampling progress is controlled by
+                the show_status and viz_callback run options.
+                Default is True.
+        num_bootstraps : int
+                Number of logZ estimators and MLFriends region bootstrap rounds.
+                Default is 30.
+        ndraw_min : int
+                Minimum number of points to simultaneously propose. Increase this if your likelihood makes vectorization very cheap.
+                Default is 128.
+        ndraw_max : int
+                Maximum number of points to simultaneously propose. Increase this if your likelihood makes vectorization very cheap.
+                Default is 65536.
+        batch_size : int, optional
+                Number of points proposed and evaluated together at each iteration, setting both ndraw_min and ndraw_max.
+                Larger batches make better use of the vectorized likelihood, at the cost of
+                wasting evaluations of proposed points that fall below the rising likelihood threshold.
+                Default is None.
+        keep_full : bool
+                Keep the full UltraNest output, e.g. the weighted samples, in `SamplerResult.sampler_results`.
+                Otherwise, only the summary entries are kept.
+                Default is False.
         See list of options here:
         https://johannesbuchner.github.io/UltraNest/ultranest.html#ultranest.integrator.ReactiveNestedSampler
 
     run_opts : dict, optional
         Optional run options passed to the given backend when running the sampler.
         https://johannesbuchner.github.io/UltraNest/ultranest.html#ultranest.integrator.ReactiveNestedSampler.run
+    compute_covariance : bool, optional
+        Whether to estimate the covariance matrix of the models from the posterior samples.
+        If False, only the parameter values and errors are updated. Default is True.
+
+    Notes
+    -----
+    UltraNest is parallelised with MPI when mpi4py is installed, by running the script with
+    ``mpiexec -n 4 python script.py``. The models are then only updated on the rank 0 process.
     """
 
-    def __init__(self, backend="ultranest", sampler_opts=None, run_opts=None):
+    def __init__(
+        self,
+        backend="ultranest",
+        sampler_opts=None,
+        run_opts=None,
+        compute_covariance=True,
+    ):
         self._sampler = None
+        self.compute_covariance = compute_covariance
         self.backend = backend
         self.sampler_opts = {} if sampler_opts is None else sampler_opts
         self.run_opts = {} if run_opts is None else run_opts
@@ -63,26 +110,128 @@ class Sampler:
             self.sampler_opts.setdefault("resume", "subfolder")
             self.sampler_opts.setdefault("step_sampler", False)
             self.sampler_opts.setdefault("nsteps", 10)
+            self.sampler_opts.setdefault("population", False)
+            self.sampler_opts.setdefault("popsize", self.sampler_opts["live_points"])
+            self.sampler_opts.setdefault("verbose", True)
+            self.sampler_opts.setdefault("num_bootstraps", 30)
+            self.sampler_opts.setdefault("ndraw_min", 128)
+            self.sampler_opts.setdefault("ndraw_max", 65536)
+            self.sampler_opts.setdefault("batch_size", None)
+            self.sampler_opts.setdefault("keep_full", False)
 
     @staticmethod
-    def _update_models_from_posterior(models, result):
+    def _update_models_from_posterior(models, result, compute_covariance=True):
         """
         Update the models with the posterior distribution.
         #TODO : add option for median, maxLogL once Param object has asym errors
         But this raises the question on how to estimate the error given the median and maxLogL.
-        Covariance matrix is not defined in this sample approach (could be approximated via the samples).
+        The covariance matrix and parameter errors are estimated from the weighted posterior samples.
         Parameters
         ----------
         models : `~gammapy.modeling.models`
             The models to update
         result : dict
             The sampler results dictionary containing the posterior distribution infos.
+        compute_covariance : bool, optional
+            Whether to estimate the covariance matrix. If False, the parameter errors
+            are set to the posterior standard deviations. Default is True.
+        Returns
+        -------
+        covariance : `~numpy.ndarray` or None
+            The covariance matrix of the free parameters, None if not computed.
+        """
+        free_parameters = models.parameters.unique_parameters.free_parameters
+
+        mean = np.asarray(result["posterior"]["mean"], dtype=np.float64)
+        for par, value in zip(free_parameters, mean.tolist()):
+            par.value = value
+
+        if not compute_covariance:
+            stdev = np.asarray(result["posterior"]["stdev"], dtype=np.float64)
+            for par, error in zip(free_parameters, stdev.tolist()):
+                par.error = error
+            return None
+
+        points = result["weighted_samples"]["points"]
+        weights = result["weighted_samples"]["weights"]
+
+        centered = points - np.average(points, axis=0, weights=weights)
+        covariance = np.einsum(
+            "ni,nj,n->ij", centered, centered, weights, optimize=True
+        )
+        covariance /= weights.sum()
+
+        scales = [par.scale for par in free_parameters]
+        # this also sets the parameter errors from the diagonal
+        models.covariance = Covariance.from_factor_matrix(
+            parameters=models.parameters,
+            matrix=covariance / np.outer(scales, scales),
+        ).data
+        return covariance
+
+    @staticmethod
+    def _prior_inverse_cdf(parameters):
         """
-        posterior = result["posterior"]
-        for i, par in enumerate(models.parameters.free_parameters):
-            par.value = posterior["mean"][i]
-            par.error = posterior["stdev"][i]
-        models._covariance = None
+        Build the vectorized inverse CDF of the parameter priors.
+        The prior coefficients are cached once per prior type, so that the transform of a
+        (N, ndim) array of values needs a single NumPy operation per prior type.
+        Parameters
+        ----------
+        parameters : `~gammapy.modeling.Parameters`
+            The models parameters to sample
+        Returns
+        -------
+        prior_inverse_cdf : callable
+            Function returning an array of model parameters of shape (N, ndim) for a given array of values (that are bound in [0,1]).
+        """
+        priors = parameters.prior
+        missing = [par.name for par, prior in zip(parameters, priors) if prior is None]
+        if missing:
+            raise ValueError(
+                f"No prior set on parameters {missing}. You need priors on all parameters."
+            )
+
+        uniform_idx = [
+            idx for idx, prior in enumerate(priors) if type(prior) is UniformPrior
+        ]
+        uniform_min = np.array([priors[idx].min.value for idx in uniform_idx])
+        uniform_width = (
+            np.array([priors[idx].max.value for idx in uniform_idx]) - uniform_min
+        )
+
+        gauss_idx = [
+            idx for idx, prior in enumerate(priors) if type(prior) is GaussianPrior
+        ]
+        gauss_mu = np.array([priors[idx].mu.value for idx in gauss_idx])
+        gauss_sigma = np.array([priors[idx].sigma.value for idx in gauss_idx])
+
+        log_uniform_idx = [
+            idx for idx, prior in enumerate(priors) if type(prior) is LogUniformPrior
+        ]
+        log_uniform_min = np.array([priors[idx].min.value for idx in log_uniform_idx])
+        log_uniform_ratio = (
+            np.array([priors[idx].max.value for idx in log_uniform_idx])
+            / log_uniform_min
+        )
+
+        other_inverse_cdfs = [
+            (idx, prior._inverse_cdf)
+            for idx, prior in enumerate(priors)
+            if idx not in uniform_idx + gauss_idx + log_uniform_idx
+        ]
+
+        def _prior_inverse_cdf(values):
+            out = np.empty_like(values)
+            out[:, uniform_idx] = uniform_min + uniform_width * values[:, uniform_idx]
+            out[:, gauss_idx] = gauss_mu + gauss_sigma * ndtri(values[:, gauss_idx])
+            out[:, log_uniform_idx] = (
+                log_uniform_min * log_uniform_ratio ** values[:, log_uniform_idx]
+            )
+            for idx, inverse_cdf in other_inverse_cdfs:
+                out[:, idx] = inverse_cdf(values[:, idx])
+            return out
+
+        return _prior_inverse_cdf
 
     def sampler_ultranest(self, parameters, like):
         """
@@ -101,23 +250,36 @@ class Sampler:
         """
         import ultranest
 
-        def _prior_inverse_cdf(values):
-            """Returns a list of model parameters for a given list of values (that are bound in [0,1])."""
-            if None in parameters:
-                raise ValueError(
-                    "Some parameters have no prior set. You need priors on all parameters."
-                )
-            return [par.prior._inverse_cdf(val) for par, val in zip(parameters, values)]
+        ndraw_min = self.sampler_opts["ndraw_min"]
+        ndraw_max = self.sampler_opts["ndraw_max"]
+
+        if self.sampler_opts["batch_size"] is not None:
+            ndraw_min = ndraw_max = self.sampler_opts["batch_size"]
 
         self._sampler = ultranest.ReactiveNestedSampler(
             parameters.names,
             like.fcn,
-            transform=_prior_inverse_cdf,
+            transform=self._prior_inverse_cdf(parameters),
             log_dir=self.sampler_opts["log_dir"],
             resume=self.sampler_opts["resume"],
+            vectorized=True,
+            num_bootstraps=self.sampler_opts["num_bootstraps"],
+            ndraw_min=ndraw_min,
+            ndraw_max=ndraw_max,
         )
 
-        if self.sampler_opts["step_sampler"]:
+        if self.sampler_opts["population"]:
+            from ultranest.popstepsampler import (
+                PopulationSliceSampler,
+                generate_cube_oriented_direction,
+            )
+
+            self._sampler.stepsampler = PopulationSliceSampler(
+                popsize=self.sampler_opts["popsize"],
+                nsteps=self.sampler_opts["nsteps"],
+                generate_direction=generate_cube_oriented_direction,
+            )
+        elif self.sampler_opts["step_sampler"]:
             from ultranest.stepsampler import (
                 SliceSampler,
                 generate_mixture_random_direction,
@@ -156,13 +318,19 @@ class Sampler:
                 function=datasets._stat_sum_likelihood, parameters=parameters
             )
             result_dict = self.sampler_ultranest(parameters, like)
-            self._sampler.print_results()
+            result = SamplerResult.from_ultranest(
+                result_dict, keep_full=self.sampler_opts["keep_full"]
+            )
 
-            models_copy = datasets.models.copy()
-            self._update_models_from_posterior(models_copy, result_dict)
+            if self._sampler.mpi_rank == 0:
+                if self.sampler_opts["verbose"]:
+                    self._sampler.print_results()
 
-            result = SamplerResult.from_ultranest(result_dict)
-            result.models = models_copy
+                models_copy = datasets.models.copy()
+                result.covariance = self._update_models_from_posterior(
+                    models_copy, result_dict, self.compute_covariance
+                )
+                result.models = models_copy
 
             return result
         else:
@@ -186,33 +354,90 @@ class SamplerResult:
     models : `~gammapy.modeling.models`
         the models updated after the sampler run.
     samples : `~numpy.ndarray`
-        array of (weighted) samples that can be used for histograms or corner plots.
+        array of equal-weighted posterior samples that can be used for histograms or corner plots.
+        The weighted samples, used for the covariance, are only kept in the sampler results with ``keep_full=True``.
     sampler_results : dict
-        output of sampler.
+        output of sampler. For UltraNest, only the summary entries are kept unless the full output is requested.
+    posterior_mean : `~numpy.ndarray`
+        mean of the posterior distribution of the free parameters.
+    posterior_stdev : `~numpy.ndarray`
+        standard deviation of the posterior distribution of the free parameters.
+    covariance : `~numpy.ndarray`
+        covariance matrix of the free parameters estimated from the posterior samples.
     """
 
+    _ultranest_result_keys = (
+        "logz",
+        "logzerr",
+        "ncall",
+        "niter",
+        "ess",
+        "maximum_likelihood",
+        "posterior",
+        "samples",
+        "insertion_order_MWW_test",
+    )
+
     def __init__(
-        self, nfev=0, success=False, models=None, samples=None, sampler_results=None
+        self,
+        nfev=0,
+        success=False,
+        models=None,
+        samples=None,
+        sampler_results=None,
+        posterior_mean=None,
+        posterior_stdev=None,
+        covariance=None,
     ):
         self.nfev = nfev
         self.success = success
         self.models = models
         self.samples = samples
         self.sampler_results = sampler_results
+        self.posterior_mean = posterior_mean
+        self.posterior_stdev = posterior_stdev
+        self.covariance = covariance
 
     @classmethod
-    def from_ultranest(cls, ultranest_result):
+    def from_ultranest(cls, ultranest_result, keep_full=False):
+        """Create result from the UltraNest results dictionary.
+
+        Parameters
+        ----------
+        ultranest_result : dict
+            Output of `ultranest.ReactiveNestedSampler.run`.
+        keep_full : bool, optional
+            Whether to keep the full output in the sampler results, including the weighted samples.
+            Otherwise, only the summary entries are kept. Default is False.
+
+        Returns
+        -------
+        result : `~gammapy.modeling.sampler.SamplerResult`
+            The sampler results.
+        """
         kwargs = {}
         kwargs["nfev"] = ultranest_result["ncall"]
         kwargs["success"] = ultranest_result["insertion_order_MWW_test"]["converged"]
         kwargs["samples"] = ultranest_result["samples"]
-        kwargs["sampler_results"] = ultranest_result
+
+        if keep_full:
+            kwargs["sampler_results"] = ultranest_result
+        else:
+            kwargs["sampler_results"] = {
+                key: ultranest_result[key]
+                for key in cls._ultranest_result_keys
+                if key in ultranest_result
+            }
+
+        kwargs["posterior_mean"] = np.asarray(ultranest_result["posterior"]["mean"])
+        kwargs["posterior_stdev"] = np.asarray(ultranest_result["posterior"]["stdev"])
         return cls(**kwargs)
 
 
 class SamplerLikelihood:
     """Wrapper of the likelihood function used by the sampler.
     This is needed to modify parameters and likelihood by *-0.5
+    The likelihood is vectorized: a (N, ndim) array of parameter values returns an array of N values.
     #TODO: Will be updated with the FitStatistic class when ready.
     Parameters
     ----------
@@ -225,8 +450,33 @@ class SamplerLikelihood:
     def __init__(self, function, parameters):
         self.function = function
         self.parameters = parameters
+        self._parameters = list(parameters)
+        self._scales = np.array([par.scale for par in parameters], dtype=np.float64)
+        self._factors = np.empty(len(parameters), dtype=np.float64)
+
+    def _set_values(self, value):
+        """Set parameter values, bypassing the `~gammapy.modeling.Parameter` setters.
+
+        The scales are fixed during sampling, so all factors are computed in a single array operation
+        into a preallocated buffer.
+        """
+        if not len(value) == len(self._parameters):
+            raise ValueError("Values must have same length as parameter list")
+
+        np.divide(value, self._scales, out=self._factors)
+        for par, factor in zip(self._parameters, self._factors.tolist()):
+            par._factor = factor
 
     def fcn(self, value):
-        self.parameters.value = value
-        total_stat = -0.5 * self.function()
-        return total_stat
+        if not isinstance(value, np.ndarray):
+            value = np.asarray(value, dtype=np.float64)
+
+        if value.ndim == 1:
+            self._set_values(value)
+            return -0.5 * self.function()
+
+        total_stat = np.empty(len(value))
+        for idx, row in enumerate(value):
+            self._set_values(row)
+            total_stat[idx] = self.function()
+        return -0.5 * total_stat
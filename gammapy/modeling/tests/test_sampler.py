@@ -1,9 +1,13 @@
+import pytest
+import numpy as np
 from gammapy.utils.testing import requires_data, requires_dependency
 from numpy.testing import assert_allclose
-from gammapy.modeling.models import SkyModel
+from gammapy.modeling import Parameter, Parameters
+from gammapy.modeling.models import Models, PowerLawSpectralModel, SkyModel
 from gammapy.datasets import Datasets, SpectrumDatasetOnOff
-from gammapy.modeling.sampler import Sampler
+from gammapy.modeling.sampler import Sampler, SamplerLikelihood, SamplerResult
 from gammapy.modeling.models import (
+    GaussianPrior,
     UniformPrior,
     LogUniformPrior,
 )
@@ -52,4 +56,181 @@ def test_run(backend="ultranest"):
 
     assert result.models.parameters["index"].error > 0
     assert result.models.parameters["amplitude"].error > 0
-    assert result.models._covariance is None
+
+    free_parameters = result.models.parameters.free_parameters
+    covariance = result.models.covariance.get_subcovariance(free_parameters).data
+    assert_allclose(covariance, np.cov(result.samples.T), rtol=0.2)
+    assert_allclose(covariance, result.covariance, rtol=1e-6)
+
+    posterior = result.sampler_results["posterior"]
+    assert_allclose(result.posterior_mean, posterior["mean"])
+    assert_allclose(result.posterior_stdev, posterior["stdev"])
+
+
+class FakeNestedSampler:
+    """Stand-in for `ultranest.ReactiveNestedSampler` recording its options."""
+
+    def __init__(self, param_names, loglike, **kwargs):
+        self.kwargs = kwargs
+        self.stepsampler = None
+
+    def run(self, **kwargs):
+        return {}
+
+
+@pytest.fixture()
+def fake_ultranest(monkeypatch):
+    import ultranest
+
+    monkeypatch.setattr(ultranest, "ReactiveNestedSampler", FakeNestedSampler)
+
+
+@pytest.fixture()
+def prior_parameters():
+    parameters = Parameters([Parameter("x", 1), Parameter("y", 2)])
+    parameters["x"].prior = UniformPrior(min=0, max=2)
+    parameters["y"].prior = GaussianPrior(mu=2, sigma=1)
+    return parameters
+
+
+@requires_dependency("ultranest")
+def test_sampler_ultranest_batch_size(fake_ultranest, prior_parameters):
+    like = SamplerLikelihood(function=lambda: 0.0, parameters=prior_parameters)
+
+    sampler = Sampler(sampler_opts={"ndraw_min": 10, "ndraw_max": 1000})
+    sampler.sampler_ultranest(prior_parameters, like)
+    assert sampler._sampler.kwargs["ndraw_min"] == 10
+    assert sampler._sampler.kwargs["ndraw_max"] == 1000
+    assert sampler._sampler.kwargs["vectorized"]
+
+    sampler = Sampler(sampler_opts={"ndraw_min": 10, "batch_size": 64})
+    sampler.sampler_ultranest(prior_parameters, like)
+    assert sampler._sampler.kwargs["ndraw_min"] == 64
+    assert sampler._sampler.kwargs["ndraw_max"] == 64
+
+
+@requires_dependency("ultranest")
+@pytest.mark.parametrize("step_sampler", [True, False])
+def test_sampler_ultranest_population(fake_ultranest, prior_parameters, step_sampler):
+    from ultranest.popstepsampler import PopulationSliceSampler
+
+    like = SamplerLikelihood(function=lambda: 0.0, parameters=prior_parameters)
+    sampler_opts = {
+        "step_sampler": step_sampler,
+        "population": True,
+        "popsize": 50,
+        "nsteps": 5,
+    }
+    sampler = Sampler(sampler_opts=sampler_opts)
+    sampler.sampler_ultranest(prior_parameters, like)
+
+    stepsampler = sampler._sampler.stepsampler
+    assert isinstance(stepsampler, PopulationSliceSampler)
+    assert stepsampler.popsize == 50
+    assert stepsampler.nsteps == 5
+
+
+def test_prior_inverse_cdf():
+    parameters = Parameters(
+        [Parameter("x", 1), Parameter("y", 2), Parameter("z", 3), Parameter("w", 4)]
+    )
+    parameters["x"].prior = UniformPrior(min=2, max=3)
+    parameters["y"].prior = GaussianPrior(mu=1, sigma=0.5)
+    parameters["z"].prior = LogUniformPrior(min=1e-12, max=1e-10)
+    parameters["w"].prior = UniformPrior(min=-1, max=1)
+
+    values = np.array([[0.1, 0.2, 0.3, 0.4], [0.5, 0.5, 0.5, 0.5]])
+    transform = Sampler._prior_inverse_cdf(parameters)
+    result = transform(values)
+
+    assert result.shape == values.shape
+    for idx, par in enumerate(parameters):
+        assert_allclose(result[:, idx], par.prior._inverse_cdf(values[:, idx]))
+
+    parameters["w"].prior = None
+    with pytest.raises(ValueError, match="No prior set on parameters \\['w'\\]"):
+        Sampler._prior_inverse_cdf(parameters)
+
+
+def test_sampler_likelihood_vectorized():
+    parameters = Parameters([Parameter("x", 1), Parameter("y", 2, scale=10)])
+
+    def function():
+        return np.sum(parameters.value**2)
+
+    like = SamplerLikelihood(function=function, parameters=parameters)
+
+    assert_allclose(like.fcn(np.array([1.0, 2.0])), -2.5)
+
+    values = np.array([[1.0, 2.0], [0.0, 3.0], [2.0, 0.0]])
+    stat = like.fcn(values)
+    assert stat.shape == (3,)
+    assert_allclose(stat, [-2.5, -4.5, -2.0])
+    assert_allclose(parameters.value, [2.0, 0.0])
+    assert_allclose(parameters["y"].factor, 0.0)
+
+    with pytest.raises(ValueError):
+        like.fcn(np.array([1.0, 2.0, 3.0]))
+
+
+def test_sampler_result_from_ultranest():
+    samples = np.ones((10, 2))
+    ultranest_result = {
+        "ncall": 100,
+        "logz": -1.0,
+        "logzerr": 0.1,
+        "posterior": {"mean": [1.0, 2.0], "stdev": [0.1, 0.2]},
+        "samples": samples,
+        "weighted_samples": {"points": samples, "weights": np.ones(10) / 10},
+        "insertion_order_MWW_test": {"converged": True},
+    }
+
+    result = SamplerResult.from_ultranest(ultranest_result)
+
+    assert result.success
+    assert result.nfev == 100
+    assert result.samples is samples
+    assert "weighted_samples" not in result.sampler_results
+    assert_allclose(result.sampler_results["logz"], -1.0)
+    assert_allclose(result.posterior_mean, [1.0, 2.0])
+    assert_allclose(result.posterior_stdev, [0.1, 0.2])
+
+    result = SamplerResult.from_ultranest(ultranest_result, keep_full=True)
+    assert result.sampler_results is ultranest_result
+
+
+@pytest.mark.parametrize("compute_covariance", [True, False])
+def test_update_models_from_posterior(compute_covariance):
+    models = Models([SkyModel(spectral_model=PowerLawSpectralModel(), name="test")])
+    models.parameters["amplitude"].scale = 1e-12
+
+    rng = np.random.default_rng(0)
+    points = rng.normal(loc=[2.5, 3e-12], scale=[0.1, 1e-13], size=(100, 2))
+    weights = rng.uniform(size=100)
+    weights /= weights.sum()
+    result = {
+        "posterior": {"mean": [2.4, 3.1e-12], "stdev": [0.2, 2e-13]},
+        "weighted_samples": {"points": points, "weights": weights},
+    }
+
+    covariance = Sampler._update_models_from_posterior(
+        models, result, compute_covariance=compute_covariance
+    )
+
+    parameters = models.parameters
+    assert_allclose(parameters["index"].value, 2.4)
+    assert_allclose(parameters["amplitude"].value, 3.1e-12)
+
+    if compute_covariance:
+        mean = np.average(points, axis=0, weights=weights)
+        variance = np.average((points - mean) ** 2, axis=0, weights=weights)
+        assert_allclose(np.diag(covariance), variance)
+
+        free_parameters = parameters.free_parameters
+        data = models.covariance.get_subcovariance(free_parameters).data
+        assert_allclose(data, covariance)
+        assert_allclose(parameters["index"].error, np.sqrt(variance[0]))
+    else:
+        assert covariance is None
+        assert_allclose(parameters["index"].error, 0.2)
+        assert_allclose(parameters["amplitude"].error, 2e-13)